@@ -15,7 +15,8 @@
 " License along with this library; if not, write to the Free Software
 " Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 "
-" 1. Place this file and pyconsole_vim.py in your Vim plugins directory,
+" 1. Place this file, pyconsole_vim.py, pyconsole.py and pyconsole_transport.py
+" in your Vim plugins directory,
 " typically: Vim\vimfiles\plugin
 "
 " 2. To run from within vim:
@@ -54,4 +55,5 @@ function! PyConsole()
 
     imap <buffer> <cr> <esc>:python vc.exec_line()<cr>
     imap <buffer> <tab> <esc>:python vc.exec_part()<cr>
+    imap <buffer> <c-c> <esc>:python vc.interrupt()<cr>
 endfunction
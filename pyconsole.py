@@ -15,9 +15,10 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-import os, sys, time, mmap, struct, ctypes, ctypes.wintypes, logging, tempfile, threading
+import os, sys, time, ctypes, ctypes.wintypes, logging, tempfile, threading
 import win32api, win32con, win32event, win32process, win32console
 user32 = ctypes.windll.user32
+import pyconsole_transport
 
 _debug = False
 if _debug:
@@ -49,29 +50,15 @@ class _ConsoleProcessBase:
     def __init__ (self, ipc_key):
         self.ipc_key = ipc_key
 
-    def _initialize (self):
-        self.event_p2c_data_empty = self._create_event ('p2c_data_empty')
-        self.event_c2p_data_empty = self._create_event ('c2p_data_empty')
-        self.event_p2c_data_ready = self._create_event ('p2c_data_ready')
-        self.event_c2p_data_ready = self._create_event ('c2p_data_ready')
-        self.shmem_p2c = None
-        self.shmem_c2p = None
-        self.shmem_p2c_bytes_in_use = 0
-        self.shmem_c2p_bytes_in_use = 0
-
     def _create_event (self, name):
         name = 'Global\\%s_%s' % (self.ipc_key, name, )
         return win32event.CreateEvent (None, 0, 0, name)
 
-    def _create_shmem (self, name, access):
-        name = "%s_%s" % (self.ipc_key, name, )
-        return mmap.mmap (0, 4096, name, access)
-
 #----------------------------------------------------------------------
 
 class ConsoleProcess (_ConsoleProcessBase):
     def __init__ (self, cmd_line, console_update=None, console_update_many=None,
-            console_process_end=None, echo=None):
+            console_process_end=None, echo=None, transport=None):
         try:
             self.console_update = console_update
             self.console_update_many = console_update_many
@@ -83,7 +70,7 @@ class ConsoleProcess (_ConsoleProcessBase):
                 os.environ['pyconsole_echo'] = str(echo)
             self.console_process_handle = None
             self.y_last = 0
-            self._initialize ()
+            self._initialize (transport)
             self._start_remote_output ()
             self._start_console_process (cmd_line)
             self._start_console_monitor ()
@@ -91,6 +78,16 @@ class ConsoleProcess (_ConsoleProcessBase):
             logging.exception ('fatal error')
             self.status_message ('ERROR %s' % e)
 
+    def _initialize (self, transport_kind):
+        '''transport_kind is one of pyconsole_transport.TRANSPORT_KINDS.
+        If not given the fastest on this host is used.  The benchmark
+        that finds it runs in the background so that vim does not wait,
+        until it is done consoles use the default kind'''
+        if not transport_kind:
+            transport_kind = pyconsole_transport.select_transport (get_python_exe(), wait=False)
+        self.transport = pyconsole_transport.create_transport (transport_kind, self.ipc_key)
+        os.environ['pyconsole_transport'] = self.transport.child_spec()
+
     def _start_console_process (self, cmd_line):
         cmd_line = '%s "%s" __child__ %s %s' % (get_python_exe(), get_this_file(), os.getpid(), cmd_line, )
         logging.info ('child cmd_line: %s' % (cmd_line, ))
@@ -101,10 +98,12 @@ class ConsoleProcess (_ConsoleProcessBase):
         si.wShowWindow = win32con.SW_HIDE
         # si.wShowWindow = win32con.SW_MINIMIZE
         try:
-            tpl_result = win32process.CreateProcess (None, cmd_line, None, None, 0, flags, None, '.', si)
+            tpl_result = win32process.CreateProcess (None, cmd_line, None, None,
+                int(self.transport.inherit_handles), flags, None, '.', si)
         except:
             self.status_message ('COULD NOT START %s' % cmd_line)
             raise
+        self.transport.child_started ()
         self.console_process_handle = tpl_result [0]
 
     def _start_remote_output (self):
@@ -113,13 +112,11 @@ class ConsoleProcess (_ConsoleProcessBase):
         t.start ()
 
     def _remote_output (self):
-        win32event.SetEvent (self.event_c2p_data_empty)
         while True:
-            rc = win32event.WaitForSingleObject (self.event_c2p_data_ready, win32event.INFINITE)
-            if self.shmem_c2p is None:
-                self.shmem_c2p = self._create_shmem ('c2p', mmap.ACCESS_READ)
-            lst_msg = shmem_read_text (self.shmem_c2p, 'iii')
-            win32event.SetEvent (self.event_c2p_data_empty)
+            try:
+                lst_msg = self.transport.c2p.read ()
+            except EOFError:
+                return
             if not lst_msg:
                 continue
             if self.console_update_many:
@@ -133,21 +130,34 @@ class ConsoleProcess (_ConsoleProcessBase):
                     self.y_last = y
 
     def write (self, text):
-        rc = win32event.WaitForSingleObject (self.event_p2c_data_empty, win32event.INFINITE)
-        if self.shmem_p2c is None:
-            self.shmem_p2c = self._create_shmem ('p2c', mmap.ACCESS_WRITE)
-        self.shmem_p2c.seek (0)
-        fmt = 'i'
-        max_len = self.shmem_p2c.size() - struct.calcsize(fmt)
-        if len(text) > max_len:
-            text = text[:max_len]   # TODO warn of truncation
-        self.shmem_p2c.write (struct.pack (fmt, len(text)))
-        self.shmem_p2c.write (text)
-        win32event.SetEvent (self.event_p2c_data_ready)
+        self.transport.p2c.write ((), text)
 
     def writeline (self, text):
         self.write (text + '\n')
 
+    def send_control (self, ctl_type, x=0, y=0):
+        '''ctl_type is one of pyconsole_transport.CTL_*.  Goes on its own
+        channel so it does not wait behind input or output'''
+        self.transport.ctl.write ((ctl_type, x, y, ), '')
+
+    def interrupt (self):
+        self.send_control (pyconsole_transport.CTL_CTRL_C)
+
+    def send_break (self):
+        self.send_control (pyconsole_transport.CTL_CTRL_BREAK)
+
+    def resize (self, width, height):
+        self.send_control (pyconsole_transport.CTL_RESIZE, width, height)
+
+    def pause (self):
+        self.send_control (pyconsole_transport.CTL_PAUSE)
+
+    def resume (self):
+        self.send_control (pyconsole_transport.CTL_RESUME)
+
+    def shutdown (self):
+        self.send_control (pyconsole_transport.CTL_SHUTDOWN)
+
     def _start_console_monitor (self):
         t = threading.Thread (target=self._console_monitor)
         t.setDaemon (True)
@@ -186,6 +196,9 @@ class _ConsoleChildProcess (_ConsoleProcessBase):
     CONSOLE_CARET_SELECTION = 1
     CONSOLE_CARET_VISIBLE   = 2
 
+    # output is paused and the console cleared once the cursor passes this row
+    Y_PAUSE = 400
+
     def __init__ (self, parent_pid, lst_cmd_line):
         try:
             _ConsoleProcessBase.__init__ (self, parent_pid)
@@ -196,6 +209,8 @@ class _ConsoleChildProcess (_ConsoleProcessBase):
             self.child_handle = None
             self.child_pid = None
             self.paused = False
+            self.paused_by_ctl = False
+            self.lock_paused = threading.Lock ()
             self.x_max = 0
             self.y_max = 0
             self.y_buffer_max = 0
@@ -216,14 +231,21 @@ class _ConsoleChildProcess (_ConsoleProcessBase):
             dct_info = self.con_stdout.GetConsoleScreenBufferInfo()
             self.y_buffer_max = dct_info['Size'].Y - 1
             self.con_window = win32console.GetConsoleWindow().handle
+            # ctrl-c and ctrl-break generated for the child must not end this process
+            win32api.SetConsoleCtrlHandler (self.console_ctrl_handler, True)
             self.set_console_event_hook ()
             self._start_paused_monitor ()
             self._child_create ()
+            self._start_remote_control ()
             self._start_remote_input ()
             self.message_pump ()
         except:
             logging.exception ('fatal error')
 
+    def _initialize (self):
+        spec = os.environ.get ('pyconsole_transport', 'shmem:%s' % self.ipc_key)
+        self.transport = pyconsole_transport.open_transport (spec)
+
     def _initialize_events (self):
         self.dct_event = {}
         for k, v in self.__class__.__dict__.items():
@@ -310,16 +332,87 @@ class _ConsoleChildProcess (_ConsoleProcessBase):
 
     def _remote_input (self):
         while True:
-            win32event.SetEvent (self.event_p2c_data_empty)
-            rc = win32event.WaitForSingleObject (self.event_p2c_data_ready, win32event.INFINITE)
-            if self.shmem_p2c is None:
-                self.shmem_p2c = self._create_shmem ('p2c', mmap.ACCESS_READ)
-            self.shmem_p2c.seek (0)
-            fmt = 'i'
-            length = struct.unpack (fmt, self.shmem_p2c.read (struct.calcsize(fmt)))[0]
-            size = min (length, self.shmem_p2c.size() - self.shmem_p2c.tell())
-            text = self.shmem_p2c.read (size)
-            self.console_input (text)
+            try:
+                lst_msg = self.transport.p2c.read ()
+            except EOFError:
+                return
+            for text_len, text in lst_msg:
+                self.console_input (text)
+
+    def _start_remote_control (self):
+        t = threading.Thread (target=self._remote_control)
+        t.setDaemon (True)
+        t.start ()
+
+    def _remote_control (self):
+        while True:
+            try:
+                lst_msg = self.transport.ctl.read ()
+            except EOFError:
+                return
+            for ctl_type, x, y, text_len, text in lst_msg:
+                # one bad request must not take the control channel down
+                try:
+                    self.console_control (ctl_type, x, y)
+                except:
+                    logging.exception ('control %s failed' % (ctl_type, ))
+
+    def console_control (self, ctl_type, x, y):
+        if ctl_type == pyconsole_transport.CTL_CTRL_C:
+            win32api.GenerateConsoleCtrlEvent (win32con.CTRL_C_EVENT, 0)
+        elif ctl_type == pyconsole_transport.CTL_CTRL_BREAK:
+            win32api.GenerateConsoleCtrlEvent (win32con.CTRL_BREAK_EVENT, 0)
+        elif ctl_type == pyconsole_transport.CTL_RESIZE:
+            if x <= 0 or y <= 0:
+                logging.warning ('invalid console size %sx%s' % (x, y, ))
+                return
+            self.resize_console (x, y)
+        elif ctl_type == pyconsole_transport.CTL_PAUSE:
+            # the paused monitor leaves this pause alone, only
+            # CTL_RESUME or input ends it
+            self.lock_paused.acquire ()
+            try:
+                self.paused_by_ctl = True
+                if not self.paused:
+                    self.paused = True
+                    self.pause ()
+            finally:
+                self.lock_paused.release ()
+        elif ctl_type == pyconsole_transport.CTL_RESUME:
+            self.lock_paused.acquire ()
+            try:
+                if self.paused:
+                    self.do_resume ()
+            finally:
+                self.lock_paused.release ()
+        elif ctl_type == pyconsole_transport.CTL_SHUTDOWN:
+            win32api.TerminateProcess (self.child_handle, 0)
+            os._exit (0)
+        else:
+            logging.warning ('unknown control %s' % (ctl_type, ))
+
+    def resize_console (self, width, height):
+        '''Make the console window width x height.  The buffer only
+        changes width, it stays tall enough for the paging at Y_PAUSE'''
+        dct_info = self.con_stdout.GetConsoleScreenBufferInfo()
+        size = dct_info['Size']
+        window = dct_info['Window']
+        buffer_height = max (size.Y, self.Y_PAUSE + height)
+        # the window has to fit inside the buffer at every step, so it
+        # shrinks before the buffer changes and grows afterwards
+        rect = win32console.PySMALL_RECTType (Left=0, Top=window.Top,
+            Right=min (window.Right - window.Left + 1, width) - 1,
+            Bottom=window.Top + min (window.Bottom - window.Top + 1, height) - 1)
+        self.con_stdout.SetConsoleWindowInfo (True, rect)
+        self.con_stdout.SetConsoleScreenBufferSize (
+            win32console.PyCOORDType (X=width, Y=buffer_height))
+        top = min (window.Top, buffer_height - height)
+        rect = win32console.PySMALL_RECTType (Left=0, Top=top,
+            Right=width - 1, Bottom=top + height - 1)
+        self.con_stdout.SetConsoleWindowInfo (True, rect)
+
+    def console_ctrl_handler (self, ctrl_type):
+        return ctrl_type in [win32con.CTRL_C_EVENT, win32con.CTRL_BREAK_EVENT]
 
     def _start_paused_monitor (self):
         self.event_paused = self._create_event ('paused')
@@ -330,8 +423,9 @@ class _ConsoleChildProcess (_ConsoleProcessBase):
     def _paused_monitor (self):
         while True:
             rc = win32event.WaitForSingleObject (self.event_paused, win32event.INFINITE)
-            busy = True
-            while busy:
+            # stop watching if something else has resumed in the meantime,
+            # or if the user has asked for the pause to stay
+            while self.paused and not self.paused_by_ctl:
                 time.sleep (0.2)
                 dct_info = self.con_stdout.GetConsoleScreenBufferInfo()
                 cursor_position = dct_info['CursorPosition']
@@ -339,7 +433,12 @@ class _ConsoleChildProcess (_ConsoleProcessBase):
                 # TODO: better solution than relying on this fudge factor
                 if self.y_current >= (y_actual - 10):
                     break
-            self.do_resume ()
+            self.lock_paused.acquire ()
+            try:
+                if self.paused and not self.paused_by_ctl:
+                    self.do_resume ()
+            finally:
+                self.lock_paused.release ()
 
     def console_input (self, text):
         # TODO if in paused state, buffer any input until unpaused
@@ -364,6 +463,7 @@ class _ConsoleChildProcess (_ConsoleProcessBase):
         self.y_max = 0
         self.y_last = 0
         self.paused = False
+        self.paused_by_ctl = False
         self.clear ()
         self.resume ()
 
@@ -420,82 +520,18 @@ class _ConsoleChildProcess (_ConsoleProcessBase):
         y = self.y_adjustment (y)
         self.relay (77, x, y, text)
         # TODO - y greater than what ?
-        if self.y_current > 400:
+        if self.y_current > self.Y_PAUSE:
             if not self.paused:
                 self.paused = True
                 self.pause ()
                 win32event.SetEvent (self.event_paused)
 
     def relay (self, msg_type, x, y, text):
-        if self.shmem_c2p is None:
-            self.shmem_c2p = self._create_shmem ('c2p', mmap.ACCESS_WRITE)
-
-        lst_event = [self.event_c2p_data_empty, self.event_c2p_data_ready]
-        rc = win32event.WaitForMultipleObjects (lst_event, 0, win32event.INFINITE)
-        event_num = rc - win32event.WAIT_OBJECT_0
-        if event_num == 0:
-            self.shmem_c2p_bytes_in_use = 0
-        # write guaranteed to work if empty, otherwise failure possible
-        new_bytes_in_use = shmem_write_text (self.shmem_c2p, self.shmem_c2p_bytes_in_use,
-                'iii', (msg_type, x, y, ), text)
-        if new_bytes_in_use == self.shmem_c2p_bytes_in_use:
-            # write could not be completed - shmem full.  wait for empty
-            win32event.SetEvent (self.event_c2p_data_ready)
-            rc = win32event.WaitForSingleObject (self.event_c2p_data_empty, win32event.INFINITE)
-            self.shmem_c2p_bytes_in_use = shmem_write_text (self.shmem_c2p, 0,
-                    'iii', (msg_type, x, y, ), text)
-        else:
-            self.shmem_c2p_bytes_in_use = new_bytes_in_use
-        win32event.SetEvent (self.event_c2p_data_ready)
+        # blocks while the parent has not caught up with earlier output
+        self.transport.c2p.write ((msg_type, x, y, ), text)
 
 #----------------------------------------------------------------------
 
-_shmem_hdr_fmt = 'i'     # btyes_used
-_shmem_hdr_len = struct.calcsize (_shmem_hdr_fmt)
-
-def shmem_write_text (shmem, bytes_in_use, msg_hdr_fmt, msg_hdr_tpl, msg_text):
-    '''Returns bytes_in_use.  If it is the same as what was passed in then
-    write was not successful because of too much data.
-    The first write can only be successful (if the message is too big it will be
-    truncated.  Successive writes however can be unsuccessful'''
-    bytes_in_use = max (bytes_in_use, _shmem_hdr_len)
-    msg_hdr_fmt += 'i'  # int indicating length of text
-    msg_hdr_len = struct.calcsize (msg_hdr_fmt)
-    msg_hdr_tpl += (len(msg_text), )
-    msg_len = msg_hdr_len + len(msg_text)
-    shmem_data_size = shmem.size () - _shmem_hdr_len
-    if msg_len > shmem_data_size:
-        # this results in the text portion of the msg being truncated
-        # client reader can detect truncation by seeing actual msg length
-        # being less that length indicated in msg_hdr
-        msg_len = shmem_data_size
-    if msg_len + bytes_in_use > shmem.size():
-        return bytes_in_use    # not enough space, need to wait
-    shmem.seek (bytes_in_use)
-    msg_hdr = struct.pack (msg_hdr_fmt, *msg_hdr_tpl)
-    shmem.write (msg_hdr)
-    # need to truncate text if it would overflow buffer
-    bytes_remaining = shmem.size() - shmem.tell()
-    shmem.write (msg_text[:bytes_remaining])
-    # update the bytes in use
-    bytes_in_use = shmem.tell ()
-    shmem.seek (0)
-    shmem.write (struct.pack (_shmem_hdr_fmt, bytes_in_use))
-    return bytes_in_use
-
-def shmem_read_text (shmem, msg_hdr_fmt):
-    lst_msg = []
-    msg_hdr_fmt += 'i'  # int indicating length of text
-    msg_hdr_len = struct.calcsize (msg_hdr_fmt)
-    shmem.seek (0)
-    bytes_in_use = struct.unpack (_shmem_hdr_fmt, shmem.read (_shmem_hdr_len))[0]
-    while shmem.tell() < bytes_in_use:
-        msg_hdr = struct.unpack (msg_hdr_fmt, shmem.read (msg_hdr_len))
-        msg_text = shmem.read (msg_hdr[-1])
-        msg_tpl = msg_hdr + (msg_text, )
-        lst_msg.append (msg_tpl)
-    return lst_msg
-
 def get_this_file ():
     try: fn = __file__
     except: fn = sys.argv[0]
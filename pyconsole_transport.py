@@ -0,0 +1,835 @@
+# PyConsole project
+# Copyright (C) 2007 Michael Graz
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+'''Parent/child channels for pyconsole.
+
+A transport is a set of one way channels: p2c carries keyboard input
+from the parent to the child, c2p carries console updates back, and
+ctl carries control requests (interrupt, resize, pause, resume and
+shutdown) from the parent.  ctl never shares a buffer with p2c or c2p
+so a control request is not held up by a large paste or by output the
+parent has not read yet.  Each channel moves messages made of a struct
+header, an int giving the text length, and the text itself.  Reading
+a channel blocks until at least one message is available and then
+returns everything queued.
+
+Implementations:
+    shmem   named shared memory ring signalled by named events
+    pipe    a pair of os.pipe
+    socket  a socketpair, written with vectored sendmsg where available
+
+Nothing here depends on pywin32 at import time so that the transports
+can be exercised on any host against the stand-in child at the bottom
+of this file.  This benchmarks each transport and checks that control
+requests get through a saturated data path within LATENCY_LIMIT:
+    python pyconsole_transport.py
+'''
+
+import os, sys, time, mmap, errno, shutil, signal, struct, socket, select, logging, tempfile, threading, subprocess
+
+P2C_HDR_FMT = ''        # text only
+C2P_HDR_FMT = 'iii'     # msg_type, x, y
+CTL_HDR_FMT = 'iii'     # ctl_type, x, y
+
+CTL_CTRL_C      = 1
+CTL_CTRL_BREAK  = 2
+CTL_RESIZE      = 3     # x, y are the new width and height
+CTL_PAUSE       = 4
+CTL_RESUME      = 5
+CTL_SHUTDOWN    = 6
+
+LATENCY_LIMIT = 0.005   # seconds, 95th percentile ctl delivery under load
+DEFAULT_KIND = 'shmem'  # used when the benchmark picks nothing
+BENCHMARK_TIMEOUT = 5.0 # seconds allowed for the whole benchmark
+
+_is_win32 = sys.platform == 'win32'
+_eof_errnos = [errno.EPIPE, errno.ECONNRESET]  # peer went away
+_empty = ''.encode ('ascii')
+_doorbell = 'x'.encode ('ascii')
+
+#----------------------------------------------------------------------
+
+class Channel:
+    '''One direction of the parent/child link'''
+    def __init__ (self, name, msg_hdr_fmt):
+        self.name = name
+        self.msg_hdr_fmt = msg_hdr_fmt + 'i'  # int indicating length of text
+        self.msg_hdr_len = struct.calcsize (self.msg_hdr_fmt)
+
+    def write (self, msg_hdr_tpl, text):
+        raise NotImplementedError
+
+    def read (self, timeout=None):
+        '''Block until data is available and return a list of message
+        tuples: msg_hdr_tpl + (text_len, text, ).  An empty list is
+        returned if nothing arrives within timeout seconds.  Pipes on
+        windows cannot be waited on and ignore the timeout.  Stream
+        channels raise EOFError when the other end goes away'''
+        raise NotImplementedError
+
+    def close (self):
+        pass
+
+    def pack_hdr (self, msg_hdr_tpl, text):
+        return struct.pack (self.msg_hdr_fmt, *(tuple(msg_hdr_tpl) + (len(text), )))
+
+class _StreamChannel (Channel):
+    '''Channel over a byte stream.  Subclasses supply _send and _recv'''
+    recv_size = 65536
+
+    def __init__ (self, name, msg_hdr_fmt):
+        Channel.__init__ (self, name, msg_hdr_fmt)
+        self.buffer = _empty
+
+    def write (self, msg_hdr_tpl, text):
+        text = to_bytes (text)
+        self._send (self.pack_hdr (msg_hdr_tpl, text), text)
+
+    def read (self, timeout=None):
+        while True:
+            lst_msg, self.buffer = unpack_messages (self.msg_hdr_fmt, self.buffer)
+            if lst_msg:
+                return lst_msg
+            if timeout is not None and not self._readable (timeout):
+                return []
+            data = self._recv ()
+            if not data:
+                raise EOFError ('%s closed' % self.name)
+            self.buffer += data
+
+class PipeChannel (_StreamChannel):
+    def __init__ (self, name, msg_hdr_fmt, fd):
+        _StreamChannel.__init__ (self, name, msg_hdr_fmt)
+        self.fd = fd
+
+    def _send (self, hdr, text):
+        data = hdr + text
+        while data:
+            count = os.write (self.fd, data)
+            data = data[count:]
+
+    def _readable (self, timeout):
+        if _is_win32:
+            return True     # select only takes sockets there
+        return select_readable (self.fd, timeout)
+
+    def _recv (self):
+        try:
+            return os.read (self.fd, self.recv_size)
+        except OSError:
+            if sys.exc_info()[1].errno in _eof_errnos:
+                raise EOFError ('%s closed' % self.name)
+            raise
+
+    def close (self):
+        if self.fd is not None:
+            os.close (self.fd)
+            self.fd = None
+
+class SocketChannel (_StreamChannel):
+    def __init__ (self, name, msg_hdr_fmt, sock):
+        _StreamChannel.__init__ (self, name, msg_hdr_fmt)
+        self.sock = sock
+
+    def _send (self, hdr, text):
+        if not hasattr (self.sock, 'sendmsg'):
+            self.sock.sendall (hdr + text)
+            return
+        # header and text go out in one syscall without being joined
+        count = self.sock.sendmsg ([hdr, text])
+        if count < len(hdr) + len(text):
+            self.sock.sendall ((hdr + text)[count:])
+
+    def _readable (self, timeout):
+        return select_readable (self.sock, timeout)
+
+    def _recv (self):
+        try:
+            return self.sock.recv (self.recv_size)
+        except socket.error:
+            if sys.exc_info()[1].args[0] in _eof_errnos:
+                raise EOFError ('%s closed' % self.name)
+            raise
+
+    def close (self):
+        self.sock.close ()
+
+class ShmemChannel (Channel):
+    '''Single producer, single consumer ring in shared memory.
+
+    The first two ints of the page are the head (next byte the writer
+    fills) and the tail (next byte the reader consumes).  One byte of
+    the ring is always left unused so that head == tail means empty.
+    The writer rings data_ready after each message and waits on
+    data_empty when the ring is full, the reader the other way round.
+    Text that would not fit in the ring goes as several messages with
+    the same header, each as large as the ring allows.'''
+    _hdr_fmt = 'ii'     # head, tail
+    _hdr_len = struct.calcsize (_hdr_fmt)
+
+    def __init__ (self, name, msg_hdr_fmt, ipc_key, directory, size=65536, owner=False):
+        Channel.__init__ (self, name, msg_hdr_fmt)
+        full_name = '%s_%s' % (ipc_key, name, )
+        self.owner = owner
+        self.shmem = create_shmem (full_name, directory, size, owner)
+        if owner:
+            # a named mapping left over from an earlier owner must start out empty
+            self.shmem[0:self._hdr_len] = struct.pack (self._hdr_fmt, 0, 0)
+        self.data_size = self.shmem.size () - self._hdr_len
+        self.event_data_ready = create_event ('%s_data_ready' % full_name, directory, owner)
+        self.event_data_empty = create_event ('%s_data_empty' % full_name, directory, owner)
+        if not _is_win32:
+            self.path = os.path.join (directory, full_name)
+
+    def _get (self, index):
+        offset = index * 4
+        return struct.unpack ('i', self.shmem[offset:offset+4])[0]
+
+    def _set (self, index, value):
+        offset = index * 4
+        self.shmem[offset:offset+4] = struct.pack ('i', value)
+
+    def write (self, msg_hdr_tpl, text):
+        text = to_bytes (text)
+        max_len = self.data_size - 1 - self.msg_hdr_len
+        pos = 0
+        while True:
+            part = text[pos:pos+max_len]
+            self._write_data (self.pack_hdr (msg_hdr_tpl, part) + part)
+            pos += max_len
+            if pos >= len(text):
+                break
+
+    def _write_data (self, data):
+        head = self._get (0)
+        while self.data_size - 1 - (head - self._get (1)) % self.data_size < len(data):
+            # not enough space, need to wait
+            self.event_data_empty.wait ()
+        start = self._hdr_len + head
+        part = min (len(data), self.data_size - head)
+        self.shmem[start:start+part] = data[:part]
+        if part < len(data):
+            self.shmem[self._hdr_len:self._hdr_len+len(data)-part] = data[part:]
+        self._set (0, (head + len(data)) % self.data_size)
+        self.event_data_ready.set ()
+
+    def read (self, timeout=None):
+        tail = self._get (1)
+        head = self._get (0)
+        while head == tail:
+            if not self.event_data_ready.wait (timeout) and timeout is not None:
+                return []
+            head = self._get (0)
+        start = self._hdr_len + tail
+        if head > tail:
+            data = self.shmem[start:self._hdr_len+head]
+        else:
+            data = self.shmem[start:] + self.shmem[self._hdr_len:self._hdr_len+head]
+        self._set (1, head)
+        self.event_data_empty.set ()
+        return unpack_messages (self.msg_hdr_fmt, data)[0]
+
+    def close (self):
+        self.shmem.close ()
+        for event in [self.event_data_ready, self.event_data_empty]:
+            event.close (self.owner)
+        if self.owner and not _is_win32:
+            remove_file (self.path)
+
+#----------------------------------------------------------------------
+
+class Transport:
+    '''Parent or child end of the p2c, c2p and ctl channels'''
+    kind = None
+    inherit_handles = False
+
+    def __init__ (self, p2c, c2p, ctl):
+        self.p2c = p2c
+        self.c2p = c2p
+        self.ctl = ctl
+
+    def available (cls):
+        return True
+    available = classmethod (available)
+
+    def child_spec (self):
+        '''String handed to the child so that it can open its end'''
+        raise NotImplementedError
+
+    def child_started (self):
+        '''Called by the parent once the child has inherited its end'''
+        pass
+
+    def close (self):
+        for channel in [self.p2c, self.c2p, self.ctl]:
+            channel.close ()
+
+class ShmemTransport (Transport):
+    '''On windows the shared memory and events are named kernel objects.
+    Elsewhere they are files in a private directory made by the parent,
+    whose path follows the ipc_key in the child spec'''
+    kind = 'shmem'
+
+    def __init__ (self, ipc_key, directory=None, owner=False):
+        self.ipc_key = ipc_key
+        self.directory = directory
+        self.owner = owner
+        Transport.__init__ (self,
+            ShmemChannel ('p2c', P2C_HDR_FMT, ipc_key, directory, owner=owner),
+            ShmemChannel ('c2p', C2P_HDR_FMT, ipc_key, directory, owner=owner),
+            ShmemChannel ('ctl', CTL_HDR_FMT, ipc_key, directory, size=4096, owner=owner))
+
+    def create (cls, ipc_key):
+        directory = None
+        if not _is_win32:
+            directory = tempfile.mkdtemp (prefix='pyconsole_')
+        try:
+            return cls (ipc_key, directory, owner=True)
+        except:
+            if directory:
+                shutil.rmtree (directory, True)
+            raise
+    create = classmethod (create)
+
+    def open (cls, arg):
+        lst_arg = arg.split (',', 1)
+        if len(lst_arg) == 1:
+            return cls (lst_arg[0])
+        return cls (lst_arg[0], lst_arg[1])
+    open = classmethod (open)
+
+    def child_spec (self):
+        if self.directory is None:
+            return '%s:%s' % (self.kind, self.ipc_key, )
+        return '%s:%s,%s' % (self.kind, self.ipc_key, self.directory, )
+
+    def close (self):
+        Transport.close (self)
+        if self.owner and self.directory:
+            shutil.rmtree (self.directory, True)
+
+class PipeTransport (Transport):
+    kind = 'pipe'
+    inherit_handles = True
+
+    def __init__ (self, fd_p2c, fd_c2p, fd_ctl, lst_fd_child=None):
+        self.lst_fd_child = lst_fd_child or []
+        Transport.__init__ (self,
+            PipeChannel ('p2c', P2C_HDR_FMT, fd_p2c),
+            PipeChannel ('c2p', C2P_HDR_FMT, fd_c2p),
+            PipeChannel ('ctl', CTL_HDR_FMT, fd_ctl))
+
+    def create (cls, ipc_key):
+        p2c_read, p2c_write = os.pipe ()
+        c2p_read, c2p_write = os.pipe ()
+        ctl_read, ctl_write = os.pipe ()
+        for fd in [p2c_write, c2p_read, ctl_write]:
+            set_inheritable (fd, False)
+        for fd in [p2c_read, c2p_write, ctl_read]:
+            set_inheritable (fd, True)
+        return cls (p2c_write, c2p_read, ctl_write, [p2c_read, c2p_write, ctl_read])
+    create = classmethod (create)
+
+    def open (cls, arg):
+        fd_p2c, fd_c2p, fd_ctl = [handle_to_fd (int(s)) for s in arg.split (',')]
+        return cls (fd_p2c, fd_c2p, fd_ctl)
+    open = classmethod (open)
+
+    def child_spec (self):
+        return '%s:%s' % (self.kind, ','.join ([str(fd_to_handle(fd)) for fd in self.lst_fd_child]))
+
+    def child_started (self):
+        for fd in self.lst_fd_child:
+            os.close (fd)
+        self.lst_fd_child = []
+
+    def close (self):
+        self.child_started ()
+        Transport.close (self)
+
+class SocketTransport (Transport):
+    kind = 'socket'
+    inherit_handles = True
+
+    def __init__ (self, sock, sock_ctl, lst_sock_child=None):
+        self.lst_sock_child = lst_sock_child or []
+        Transport.__init__ (self,
+            SocketChannel ('p2c', P2C_HDR_FMT, sock),
+            SocketChannel ('c2p', C2P_HDR_FMT, sock),
+            SocketChannel ('ctl', CTL_HDR_FMT, sock_ctl))
+
+    def available (cls):
+        return hasattr (socket, 'AF_UNIX') and hasattr (socket, 'socketpair') \
+            and hasattr (socket, 'fromfd')
+    available = classmethod (available)
+
+    def create (cls, ipc_key):
+        lst_sock = []
+        lst_sock_child = []
+        for i in range (2):
+            sock, sock_child = socket.socketpair (socket.AF_UNIX, socket.SOCK_STREAM)
+            set_inheritable (sock.fileno(), False)
+            set_inheritable (sock_child.fileno(), True)
+            lst_sock.append (sock)
+            lst_sock_child.append (sock_child)
+        return cls (lst_sock[0], lst_sock[1], lst_sock_child)
+    create = classmethod (create)
+
+    def open (cls, arg):
+        lst_sock = []
+        for s in arg.split (','):
+            fd = int(s)
+            lst_sock.append (socket.fromfd (fd, socket.AF_UNIX, socket.SOCK_STREAM))
+            os.close (fd)   # fromfd made a duplicate
+        return cls (lst_sock[0], lst_sock[1])
+    open = classmethod (open)
+
+    def child_spec (self):
+        return '%s:%s' % (self.kind, ','.join ([str(sock.fileno()) for sock in self.lst_sock_child]))
+
+    def child_started (self):
+        for sock in self.lst_sock_child:
+            sock.close ()
+        self.lst_sock_child = []
+
+    def close (self):
+        self.child_started ()
+        Transport.close (self)
+
+_dct_transport = {}
+for _cls in [ShmemTransport, PipeTransport, SocketTransport]:
+    _dct_transport[_cls.kind] = _cls
+TRANSPORT_KINDS = ['shmem', 'pipe', 'socket']
+
+def available_kinds ():
+    return [kind for kind in TRANSPORT_KINDS if _dct_transport[kind].available()]
+
+def create_transport (kind, ipc_key):
+    '''Create the parent end of a transport'''
+    if kind not in _dct_transport:
+        raise ValueError ('unknown transport %r' % (kind, ))
+    return _dct_transport[kind].create (ipc_key)
+
+def open_transport (spec):
+    '''Open the child end of a transport from Transport.child_spec()'''
+    kind, arg = spec.split (':', 1)
+    if kind not in _dct_transport:
+        raise ValueError ('unknown transport %r' % (kind, ))
+    return _dct_transport[kind].open (arg)
+
+#----------------------------------------------------------------------
+
+def create_shmem (name, directory, size, owner):
+    if _is_win32:
+        return mmap.mmap (-1, size, name)
+    # named shared memory is emulated with a file mapping.  Only the
+    # owner creates the file, and never over something already there
+    path = os.path.join (directory, name)
+    if owner:
+        flags = os.O_RDWR | os.O_CREAT | os.O_EXCL
+    else:
+        flags = os.O_RDWR
+    fd = os.open (path, flags | getattr (os, 'O_NOFOLLOW', 0), 384)   # 0600
+    try:
+        if owner:
+            os.ftruncate (fd, size)
+        return mmap.mmap (fd, size)
+    finally:
+        os.close (fd)
+
+def create_event (name, directory, owner):
+    if _is_win32:
+        return _Win32Event (name)
+    return _FifoEvent (os.path.join (directory, name), owner)
+
+class _Win32Event:
+    '''Auto reset named event'''
+    def __init__ (self, name):
+        import win32event, win32api
+        self.win32event = win32event
+        self.win32api = win32api
+        self.handle = win32event.CreateEvent (None, 0, 0, 'Global\\%s' % name)
+
+    def set (self):
+        self.win32event.SetEvent (self.handle)
+
+    def wait (self, timeout=None):
+        if timeout is None:
+            ms = self.win32event.INFINITE
+        else:
+            ms = int (timeout * 1000)
+        rc = self.win32event.WaitForSingleObject (self.handle, ms)
+        return rc == self.win32event.WAIT_OBJECT_0
+
+    def close (self, owner):
+        self.win32api.CloseHandle (self.handle)
+
+class _FifoEvent:
+    '''Auto reset named event built from a fifo.  Setting writes a byte,
+    waiting drains every byte so that repeated sets coalesce'''
+    def __init__ (self, path, owner):
+        self.path = path
+        if owner:
+            os.mkfifo (self.path, 384)   # 0600, fails if the path exists
+        # opening read-write never blocks waiting for the other side
+        self.fd = os.open (self.path, os.O_RDWR | os.O_NONBLOCK | getattr (os, 'O_NOFOLLOW', 0))
+
+    def set (self):
+        try:
+            os.write (self.fd, _doorbell)
+        except OSError:
+            pass    # fifo full, the event is already set
+
+    def wait (self, timeout=None):
+        if not select_readable (self.fd, timeout):
+            return False
+        try:
+            os.read (self.fd, 4096)
+        except OSError:
+            pass    # another waiter got there first
+        return True
+
+    def close (self, owner):
+        os.close (self.fd)
+        if owner:
+            remove_file (self.path)
+
+def select_readable (fileno, timeout):
+    '''True if fileno can be read without blocking within timeout seconds'''
+    while True:
+        try:
+            return bool (select.select ([fileno], [], [], timeout)[0])
+        except select.error:
+            if sys.exc_info()[1].args[0] != errno.EINTR:
+                raise
+
+def remove_file (path):
+    try:
+        os.remove (path)
+    except OSError:
+        pass
+
+#----------------------------------------------------------------------
+
+def to_bytes (text):
+    if isinstance (text, type(_empty)):
+        return text
+    return text.encode ('ascii', 'replace')
+
+def unpack_messages (msg_hdr_fmt, data):
+    '''Split data into complete messages.  Returns (lst_msg, remainder)'''
+    lst_msg = []
+    msg_hdr_len = struct.calcsize (msg_hdr_fmt)
+    pos = 0
+    while len(data) - pos >= msg_hdr_len:
+        msg_hdr = struct.unpack (msg_hdr_fmt, data[pos:pos+msg_hdr_len])
+        end = pos + msg_hdr_len + msg_hdr[-1]
+        if end > len(data):
+            break
+        lst_msg.append (msg_hdr + (data[pos+msg_hdr_len:end], ))
+        pos = end
+    return lst_msg, data[pos:]
+
+def set_inheritable (fd, inheritable):
+    if hasattr (os, 'set_inheritable'):
+        os.set_inheritable (fd, inheritable)
+    elif _is_win32:
+        import msvcrt, win32api, win32con
+        win32api.SetHandleInformation (msvcrt.get_osfhandle(fd),
+            win32con.HANDLE_FLAG_INHERIT, int(inheritable))
+    else:
+        import fcntl
+        flags = fcntl.fcntl (fd, fcntl.F_GETFD)
+        if inheritable:
+            flags &= ~fcntl.FD_CLOEXEC
+        else:
+            flags |= fcntl.FD_CLOEXEC
+        fcntl.fcntl (fd, fcntl.F_SETFD, flags)
+
+def fd_to_handle (fd):
+    '''File descriptors are per process on windows, only the os handle
+    survives into the child'''
+    if _is_win32:
+        import msvcrt
+        return msvcrt.get_osfhandle (fd)
+    return fd
+
+def handle_to_fd (handle):
+    if _is_win32:
+        import msvcrt
+        return msvcrt.open_osfhandle (handle, 0)
+    return handle
+
+#----------------------------------------------------------------------
+
+_kind_selected = None
+_thread_select = None
+_lock_select = threading.Lock ()
+
+def select_transport (python_exe=None, wait=True):
+    '''Kind of the fastest transport on this host.  The benchmark only
+    runs once, afterwards the result is remembered.  With wait false
+    the benchmark runs on a thread of its own and DEFAULT_KIND is
+    returned until it has finished'''
+    global _thread_select
+    _lock_select.acquire ()
+    try:
+        if _kind_selected is None and _thread_select is None:
+            _thread_select = threading.Thread (target=_select, args=(python_exe, ))
+            _thread_select.setDaemon (True)
+            _thread_select.start ()
+        t = _thread_select
+    finally:
+        _lock_select.release ()
+    if _kind_selected is None:
+        if not wait:
+            return DEFAULT_KIND
+        t.join ()
+    return _kind_selected
+
+def _select (python_exe):
+    global _kind_selected
+    try:
+        lst_result = benchmark (python_exe=python_exe)
+    except Exception:
+        logging.exception ('transport benchmark failed')
+        lst_result = []
+    if lst_result:
+        _kind_selected = lst_result[0][1]
+    else:
+        _kind_selected = DEFAULT_KIND
+    logging.info ('selected transport %s from %s' % (_kind_selected, lst_result, ))
+
+def benchmark (kinds=None, count=2000, text_len=64, python_exe=None,
+        timeout=BENCHMARK_TIMEOUT):
+    '''Time count messages going to a stand-in child and echoed back,
+    for each kind.  Returns a list of (seconds, kind) fastest first.
+    Kinds that fail, or that are still running when timeout seconds
+    have passed for the benchmark as a whole, are left out'''
+    lst_result = []
+    deadline = time.time () + timeout
+    for kind in kinds or available_kinds ():
+        remaining = deadline - time.time ()
+        if remaining <= 0:
+            logging.warning ('benchmark out of time before %s transport' % kind)
+            break
+        try:
+            seconds = _benchmark_one (kind, count, text_len, python_exe, remaining)
+        except Exception:
+            logging.exception ('benchmark of %s transport failed' % kind)
+            continue
+        lst_result.append ((seconds, kind, ))
+    lst_result.sort ()
+    return lst_result
+
+def _benchmark_one (kind, count, text_len, python_exe, timeout):
+    transport, child = start_stand_in_child (kind, python_exe)
+    watchdog = _start_watchdog (child, timeout)
+    try:
+        try:
+            text = 'x' * text_len
+            # one round trip first so that child start up is not counted
+            transport.p2c.write ((), text)
+            read_stand_in_child (transport, child)
+            t = threading.Thread (target=_write_many, args=(transport.p2c, count, text, ))
+            t.setDaemon (True)
+            time_start = time.time ()
+            t.start ()
+            received = 0
+            while received < count:
+                received += len (read_stand_in_child (transport, child))
+            seconds = time.time () - time_start
+            t.join ()
+            stop_stand_in_child (transport, child)
+        except:
+            _kill_child (child)
+            child.wait ()
+            transport.close ()
+            raise
+    finally:
+        watchdog.cancel ()
+    return seconds
+
+def _write_many (channel, count, text):
+    try:
+        for i in range (count):
+            channel.write ((), text)
+    except (EnvironmentError, socket.error):
+        pass    # the child went away, the reader reports it
+
+def latency_test (kind, count=100, text_len=16384, python_exe=None,
+        timeout=BENCHMARK_TIMEOUT):
+    '''Send count CTL_CTRL_C requests while another thread keeps p2c
+    full and c2p is left unread, so that the stand-in child is stalled
+    writing output the whole time.  Returns the one way delivery time
+    of each request in seconds.  The child is killed if the test takes
+    longer than timeout'''
+    transport, child = start_stand_in_child (kind, python_exe)
+    watchdog = _start_watchdog (child, timeout)
+    lst_flooding = [True]
+    t = threading.Thread (target=_flood, args=(transport.p2c, lst_flooding, 'x' * text_len, ))
+    t.setDaemon (True)
+    t.start ()
+    try:
+        try:
+            time.sleep (0.1)    # give p2c and c2p time to fill up
+            for i in range (count):
+                transport.ctl.write ((CTL_CTRL_C, 0, 0, ), repr (time.time ()))
+                time.sleep (0.001)
+            lst_flooding[0] = False
+            # the empty message written last by _flood marks the end of the data
+            done = False
+            while not done:
+                for msg in read_stand_in_child (transport, child):
+                    done = done or not msg[-1]
+            t.join ()
+            return stop_stand_in_child (transport, child)
+        except:
+            _kill_child (child)
+            child.wait ()
+            transport.close ()
+            raise
+    finally:
+        watchdog.cancel ()
+
+def _flood (channel, lst_flooding, text):
+    try:
+        while lst_flooding[0]:
+            channel.write ((), text)
+        channel.write ((), '')
+    except (EnvironmentError, socket.error):
+        pass    # the child went away, the reader reports it
+
+def start_stand_in_child (kind, python_exe=None):
+    '''Start a plain python process that echoes each p2c message back
+    on c2p and times each ctl message.  Returns (transport, subprocess.Popen)'''
+    ipc_key = '%s_%s' % (os.getpid(), kind, )
+    transport = create_transport (kind, ipc_key)
+    cmd_line = [python_exe or sys.executable, os.path.abspath (__file__),
+        '__child__', transport.child_spec()]
+    si = None
+    if _is_win32:
+        # keep the child's console hidden, as ConsoleProcess does
+        import win32con
+        si = subprocess.STARTUPINFO ()
+        si.dwFlags |= win32con.STARTF_USESHOWWINDOW
+        si.wShowWindow = win32con.SW_HIDE
+    try:
+        child = subprocess.Popen (cmd_line, close_fds=not transport.inherit_handles,
+            startupinfo=si)
+    except:
+        transport.close ()
+        raise
+    transport.child_started ()
+    return transport, child
+
+def read_stand_in_child (transport, child):
+    '''Read c2p from a stand-in child.  Raises EOFError once the child
+    has exited rather than waiting for data that will never come'''
+    while True:
+        lst_msg = transport.c2p.read (0.1)
+        if lst_msg:
+            return lst_msg
+        if child.poll () is not None:
+            raise EOFError ('stand-in child exited with %s' % (child.returncode, ))
+
+def _start_watchdog (child, timeout):
+    '''Kill child after timeout seconds unless cancelled first.  Reads
+    from a killed child end with EOFError instead of waiting forever'''
+    watchdog = threading.Timer (timeout, _kill_child, args=(child, ))
+    watchdog.setDaemon (True)
+    watchdog.start ()
+    return watchdog
+
+def _kill_child (child):
+    if child.poll () is not None:
+        return      # already gone, and its pid may belong to another process
+    try:
+        if hasattr (child, 'kill'):
+            child.kill ()
+        elif _is_win32:
+            # Popen.kill is python 2.6 and later
+            import win32api
+            win32api.TerminateProcess (int(child._handle), 1)
+        else:
+            os.kill (child.pid, signal.SIGKILL)
+    except Exception:
+        pass    # exited in the meantime
+
+def stop_stand_in_child (transport, child):
+    '''Shut the child down and return the latencies it measured for the
+    ctl messages that carried a send time'''
+    transport.ctl.write ((CTL_SHUTDOWN, 0, 0, ), '')
+    lst_latency = None
+    while lst_latency is None:
+        for msg in read_stand_in_child (transport, child):
+            if msg[0] == 0:
+                lst_latency = [float(s) for s in msg[-1].split (to_bytes(',')) if s]
+    child.wait ()
+    transport.close ()
+    return lst_latency
+
+def _stand_in_child (spec):
+    transport = open_transport (spec)
+    lock_c2p = threading.Lock ()
+    t = threading.Thread (target=_stand_in_echo, args=(transport, lock_c2p, ))
+    t.setDaemon (True)
+    t.start ()
+    lst_latency = []
+    while True:
+        for ctl_type, x, y, text_len, text in transport.ctl.read ():
+            if text:
+                lst_latency.append (time.time () - float(text))
+            if ctl_type == CTL_SHUTDOWN:
+                lock_c2p.acquire ()
+                transport.c2p.write ((0, 0, 0, ), ','.join (['%.6f' % f for f in lst_latency]))
+                # the echo thread is still blocked reading p2c, exiting
+                # normally would have it fail during interpreter shutdown
+                os._exit (0)
+
+def _stand_in_echo (transport, lock_c2p):
+    y = 0
+    while True:
+        for msg in transport.p2c.read ():
+            y += 1
+            lock_c2p.acquire ()
+            try:
+                transport.c2p.write ((77, 0, y, ), msg[-1])
+            finally:
+                lock_c2p.release ()
+
+#----------------------------------------------------------------------
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 3 and sys.argv[1] == '__child__':
+        _stand_in_child (sys.argv[2])
+    else:
+        for seconds, kind in benchmark ():
+            print ('%-8s %.3fs' % (kind, seconds, ))
+        print ('selected %s' % (select_transport (), ))
+        failed = False
+        for kind in available_kinds ():
+            lst_latency = latency_test (kind)
+            lst_latency.sort ()
+            median = lst_latency[len(lst_latency) // 2]
+            p95 = lst_latency[min (len(lst_latency) - 1, int(len(lst_latency) * 0.95))]
+            print ('%-8s ctl latency median %.2fms p95 %.2fms max %.2fms' % (kind,
+                median * 1000, p95 * 1000, lst_latency[-1] * 1000, ))
+            if p95 > LATENCY_LIMIT:
+                print ('%-8s ctl latency p95 over %.2fms' % (kind, LATENCY_LIMIT * 1000, ))
+                failed = True
+        sys.exit (int(failed))